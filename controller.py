@@ -1,5 +1,7 @@
 import json
 
+from profiling import traced
+
 
 class TrackerController:
     def __init__(self, pattern):
@@ -14,10 +16,61 @@ class TrackerController:
         """Get the current drum pattern."""
         return self.pattern.get_pattern()
 
-    def add_note_to_track(self, track, step, note):
+    def get_pattern_at(self, pattern_index):
+        """Get the pattern at the given index without switching to it."""
+        return self.pattern.get_pattern_at(pattern_index)
+
+    def get_current_pattern_index(self):
+        return self.pattern.get_current_pattern_index()
+
+    def add_note_to_track(self, track, step, note, velocity=None, pattern_index=None):
         """Add a MIDI note to the specified track (e.g., main voice or chord track)."""
         # Assuming each step can hold one MIDI note value for now
-        self.pattern.set_note_for_track(track, step, note)
+        self.pattern.set_note_for_track(track, step, note, pattern_index)
+        if velocity is not None:
+            self.pattern.set_velocity(track, step, velocity, pattern_index)
+
+    def get_velocities_at(self, pattern_index):
+        return self.pattern.get_velocities_at(pattern_index)
+
+    def set_velocity(self, track, step, velocity):
+        self.pattern.set_velocity(track, step, velocity)
+
+    def set_automation_point(self, control, step, value, channel=3):
+        self.pattern.set_automation_point(control, step, value, channel)
+
+    def get_automation_points(self, control, channel=3):
+        return self.pattern.get_automation_points(control, channel)
+
+    def get_automation_version(self):
+        return self.pattern.get_automation_version()
+
+    def compile_automation(self, pattern_index):
+        return self.pattern.compile_automation(pattern_index)
+
+    # Bulk transforms, the caller refreshes the view once afterwards
+    def transpose(self, semitones, tracks, start, end):
+        self.pattern.transpose(semitones, tracks, start, end)
+        return self.pattern.get_pattern()
+
+    def rotate(self, steps, tracks, start, end):
+        self.pattern.rotate(steps, tracks, start, end)
+        return self.pattern.get_pattern()
+
+    def copy_block(self, tracks, start, end):
+        return self.pattern.copy_block(tracks, start, end)
+
+    def paste_block(self, block, step, track_offset=0, pattern_index=None):
+        self.pattern.paste_block(block, step, track_offset, pattern_index)
+        return self.pattern.get_pattern()
+
+    def euclidean_fill(self, track, pulses, length=16, rotation=0):
+        self.pattern.euclidean_fill(track, pulses, length, rotation)
+        return self.pattern.get_pattern()
+
+    def humanize(self, tracks, start, end, amount=16):
+        self.pattern.humanize(tracks, start, end, amount)
+        return self.pattern.get_pattern()
 
     def get_bpm(self):
         return self.pattern.get_bpm()
@@ -26,12 +79,14 @@ class TrackerController:
         self.pattern.set_bpm(bpm)
 
     # Adjust saving to include metadata
+    @traced('io')
     def save_song(self, filepath):
         song_data = self.pattern.get_song_data()
         with open(filepath, 'w') as f:
             json.dump(song_data, f)
         print(f"Song saved to {filepath}")
 
+    @traced('io')
     def load_song(self, filepath):
         with open(filepath, 'r') as f:
             song_data = json.load(f)
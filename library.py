@@ -0,0 +1,152 @@
+import json
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from profiling import traced
+
+INDEX_FILE = '.songindex.json'
+INDEX_VERSION = 1
+
+
+def song_metadata(filepath):
+    """Parse a song file and extract the metadata kept in the library index."""
+    with open(filepath, 'r') as f:
+        song_data = json.load(f)
+    patterns = song_data['patterns']
+    used_tracks = set()
+    filled = 0
+    cells = 0
+    thumbnail = []
+    for pattern in patterns:
+        # Thumbnail: per track a 16 bit mask, one bit per block of 4 steps that holds a note
+        track_bits = []
+        for track, steps in enumerate(pattern):
+            bits = 0
+            for step, value in enumerate(steps):
+                if value > 0:
+                    bits |= 1 << (step // 4)
+                    filled += 1
+                    used_tracks.add(track)
+            cells += len(steps)
+            track_bits.append(bits)
+        thumbnail.append(track_bits)
+    return {
+        'bpm': song_data['metadata']['bpm'],
+        'pattern_sequence': song_data.get('pattern_sequence', [1] * 10),
+        'note_density': filled / cells if cells else 0,
+        'used_tracks': sorted(used_tracks),
+        'thumbnail': thumbnail,
+    }
+
+
+def thumbnail_text(thumbnail, pattern_index=0):
+    """Render one pattern of a thumbnail as text, one line per track."""
+    lines = []
+    for bits in thumbnail[pattern_index]:
+        lines.append(''.join('#' if bits & (1 << block) else '.' for block in range(16)))
+    return '\n'.join(lines)
+
+
+class SongLibrary:
+    def __init__(self, directory, workers=8):
+        self.directory = directory
+        self.workers = workers
+        self.index_path = os.path.join(directory, INDEX_FILE)
+        self.songs = {}  # File name -> index entry
+        self.load_index()
+
+    def load_index(self):
+        """Read the persisted index, a missing or outdated index starts empty."""
+        try:
+            with open(self.index_path, 'r') as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return
+        if index.get('version') == INDEX_VERSION:
+            self.songs = index['songs']
+
+    @traced('io')
+    def save_index(self):
+        # Write to a temporary file first so an interrupted save never corrupts the index,
+        # each save gets its own file so concurrent scans of one directory don't collide
+        temp_path = None
+        try:
+            with tempfile.NamedTemporaryFile('w', dir=self.directory, suffix='.tmp', delete=False) as f:
+                temp_path = f.name
+                json.dump({'version': INDEX_VERSION, 'songs': self.songs}, f)
+            os.replace(temp_path, self.index_path)
+        except OSError as e:
+            # A read-only or full directory only costs the next scan its head start
+            print(f"Could not save library index {self.index_path}: {e}")
+            if temp_path is not None and os.path.exists(temp_path):
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+
+    @traced('io')
+    def scan(self):
+        """Bring the index up to date with the directory and return the number of files parsed."""
+        current = {}
+        stale = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_file() or not entry.name.endswith('.json') or entry.name == INDEX_FILE:
+                continue
+            stat = entry.stat()
+            current[entry.name] = (stat.st_mtime_ns, stat.st_size)
+            known = self.songs.get(entry.name)
+            # A file is only parsed again when its modification time or size changed
+            if known is None or (known['mtime'], known['size']) != current[entry.name]:
+                stale.append(entry.name)
+
+        # Build a new dict and swap it in at the end, so searches from other threads never see it half done
+        songs = {name: song for name, song in self.songs.items() if name in current}
+        changed = len(songs) != len(self.songs) or bool(stale)
+        if stale:
+            paths = [os.path.join(self.directory, name) for name in stale]
+            # Parsing holds the GIL, so the pool mostly overlaps file reads rather than parsing in parallel
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                for name, metadata in zip(stale, pool.map(self.try_metadata, paths)):
+                    if metadata is None:
+                        # Remember files that are not songs, so they are not parsed again until they change
+                        metadata = {'error': True}
+                    metadata['mtime'], metadata['size'] = current[name]
+                    songs[name] = metadata
+        self.songs = songs
+        if changed:
+            self.save_index()
+        return len(stale)
+
+    @traced('io')
+    def try_metadata(self, filepath):
+        try:
+            return song_metadata(filepath)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"Skipping {filepath}: {e}")
+            return None
+
+    def search(self, text="", min_bpm=None, max_bpm=None, track=None):
+        """Return the names of indexed songs matching all given filters, sorted by name."""
+        text = text.lower()
+        results = []
+        for name, song in self.songs.items():
+            if song.get('error'):
+                continue
+            if text and text not in name.lower():
+                continue
+            if min_bpm is not None and song['bpm'] < min_bpm:
+                continue
+            if max_bpm is not None and song['bpm'] > max_bpm:
+                continue
+            if track is not None and track not in song['used_tracks']:
+                continue
+            results.append(name)
+        return sorted(results)
+
+    def get_song(self, name):
+        """Return the index entry for a song."""
+        return self.songs[name]
+
+    def get_path(self, name):
+        return os.path.join(self.directory, name)
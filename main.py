@@ -2,9 +2,10 @@
 
 import pygame.midi
 import sys
+import profiling
 from PyQt5.QtWidgets import QApplication
 from controller import TrackerController
-from midi import MidiPlayer
+from midi import MidiPlayer, MidiRecorder
 from model import TrackerPattern
 from ui import TrackerApp
 
@@ -31,13 +32,18 @@ def main():
     # Initialize MIDI player
     midi_player = MidiPlayer(controller)
 
-    # Create and show the UI, passing the controller and MIDI player
-    window = TrackerApp(controller, midi_player)
+    # Initialize MIDI input recorder, quantizing against the player's clock
+    midi_recorder = MidiRecorder(controller, midi_player)
+
+    # Create and show the UI, passing the controller, MIDI player and recorder
+    window = TrackerApp(controller, midi_player, midi_recorder)
     window.show()
 
     # Start the event loop
     result = app.exec_()
+    midi_recorder.close()
     midi_player.close()
+    profiling.export()  # Only writes when MIDITRACKER_TRACE is set
     sys.exit(result)
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -2,6 +2,8 @@ import pygame.midi
 import time
 import threading
 
+from profiling import traced
+
 class MidiPlayer:
     def __init__(self, controller):
         self.controller = controller
@@ -10,6 +12,22 @@ class MidiPlayer:
         self.play_thread = None
         self.channel = 2  # MIDI channels are 0-indexed, so 3 is channel 2
         self.current_notes = [0] * 10
+        self.sequence = -1
+        self.mask = 15
+        self.loop_start = 0
+        self.loop_end = 64
+        self.pattern_chain = []
+        self.chain_position = 0
+        self.pattern_index = None
+        self.pending_pattern = 0
+        self.pending_events = []
+        self.pending_cc = []
+        self.compiled_automation = []
+        self.compiled_key = None  # (pattern index, automation version) the compiled lanes belong to
+        self.last_cc = {}  # (channel, control) -> last value sent, so unchanged values are not resent
+        # (previous pattern, pattern, step, pygame.midi.time(), next pattern) of the last step sent
+        self.step_clock = (0, 0, 0, 0, 0)
+        self.step_ms = 125
         pygame.midi.init()
         # Change the output to another device if needed...
         self.midi_out = pygame.midi.Output(0)  # Open MIDI output
@@ -63,18 +81,46 @@ class MidiPlayer:
     def song(self):
         self.start(0)
 
-    def next_song_sequence(self):
-        pattern = self.controller.get_pattern_sequence()[self.sequence] - 1
-        self.controller.switch_to_pattern(pattern)
-        self.mask = self.controller.get_track_masks()[self.sequence]
-        self.current_step = 0
+    def set_loop_region(self, start=0, end=64):
+        """Loop playback over steps start..end-1 of every pattern."""
+        if not 0 <= start < end <= 64:
+            raise ValueError("Loop region out of range")
+        self.loop_start = start
+        self.loop_end = end
+
+    def set_pattern_chain(self, chain):
+        """Chain patterns (0-based indices) for pattern playback, an empty chain loops the current pattern."""
+        for pattern_index in chain:
+            if not 0 <= pattern_index < 4:
+                raise ValueError("Pattern index out of range")
+        self.pattern_chain = list(chain)
+
+    def enter_sequence(self):
+        """Resolve the pattern and mask of the current song slot or chain position.
+
+        Only the player moves on here, the UI switches its pattern when the first step is played.
+        """
+        if self.sequence >= 0:
+            self.pattern_index = self.controller.get_pattern_sequence()[self.sequence] - 1
+            self.mask = self.controller.get_track_masks()[self.sequence]
+        elif self.pattern_chain:
+            self.pattern_index = self.pattern_chain[self.chain_position]
+            self.mask = 15
+        else:
+            # Plain playback follows whatever pattern is selected in the UI
+            self.pattern_index = None
+            self.mask = 15
 
     def start(self, sequence = -1):
         """Start playback in a separate thread."""
         self.sequence = sequence
-        self.mask = 15
-        if sequence != -1:
-            self.next_song_sequence()
+        self.chain_position = 0
+        self.current_step = self.loop_start
+        self.last_cc = {}
+        self.enter_sequence()
+        self.resolve_events()
+        self.step_clock = (self.pending_pattern, self.pending_pattern, self.current_step, pygame.midi.time(),
+                           self.pending_pattern)
         if not self.is_playing:
             self.is_playing = True
             self.play_thread = threading.Thread(target=self.play_loop)
@@ -101,7 +147,10 @@ class MidiPlayer:
         bpm = self.controller.get_bpm()
         steps_per_second = (bpm / 60) * 4
         time_interval = 1 / steps_per_second
+        self.step_ms = time_interval * 1000
 
+        # Ticks are scheduled against a fixed clock so work done on one tick never delays the next
+        next_tick = time.perf_counter()
         while self.is_playing:
             self.play_step()
             time.sleep(0.01)
@@ -109,48 +158,96 @@ class MidiPlayer:
                 if self.current_notes[track] > 0:
                     self.play_midi_off(9, self.current_notes[track])
                     self.current_notes[track] = 0;
-            time.sleep(time_interval)
+            next_tick += time_interval
+            delay = next_tick - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -time_interval:
+                # After a stall resync instead of firing a burst of steps to catch up
+                next_tick = time.perf_counter()
 
+    @traced('playback')
     def play_step(self):
-        """Play the notes for the current step in the drum pattern."""
-        pattern = self.controller.get_pattern()
+        """Play the notes resolved for the current step, then resolve the next step."""
+        for channel, control, value in self.pending_cc:
+            self.cc(value, control, channel)
+        for track, channel, note, velocity in self.pending_events:
+            if self.current_notes[track] > 0:
+                self.play_midi_off(channel, self.current_notes[track])
+            if note > 0:
+                self.play_midi_on(channel, note, velocity)
+            self.current_notes[track] = note
+        step_time = pygame.midi.time()
+        played_pattern = self.pending_pattern
+        played_step = self.current_step
 
-        self.song_position_signal.emit(f"{self.sequence}/{self.current_step}")
+        # The pattern is -1 when playback follows the pattern selected in the UI
+        playing_pattern = -1 if self.pattern_index is None else self.pending_pattern
+        self.song_position_signal.emit(f"{self.sequence}/{self.current_step}/{playing_pattern}")
 
-        for track in range(10):
-            if track < 5:
-                channel = self.channel
-                if track == 0:
-                    channel = 3
-                note = pattern[track][self.current_step]
-                if note > 0:
-                    if self.current_notes[track] > 0:
-                        self.play_midi_off(channel, self.current_notes[track])
-                    if note < 128 and ((self.mask & 1 > 0 and channel == 3) or (self.mask & 2 > 0 and channel != 3)):
-                        self.play_midi_on(channel, note)
-                        self.current_notes[track] = note
-                    else:
-                        self.current_notes[track] = 0
-            else:
-                if pattern[track][self.current_step] == 1:
-                    if self.current_notes[track] > 0:
-                       self.play_midi_off(9, self.current_notes[track])
-                    note = self.midi_notes[track]
-                    if note > 0 and ((self.mask & 4 > 0 and track == 5) or (self.mask & 8 > 0 and track > 5)):
-                        self.play_midi_on(9, note)
-                        self.current_notes[track] = note
-        # Move to the next step
-        self.current_step = (self.current_step + 1) % 64
-        if self.sequence >= 0:
-            if self.current_step == 0:
+        # Move to the next step, pattern boundaries are crossed here so the next tick only sends events
+        self.current_step = self.current_step + 1
+        if self.current_step >= self.loop_end:
+            self.current_step = self.loop_start
+            if self.sequence >= 0:
                 self.sequence = self.sequence + 1
                 if self.sequence > 7:
                     self.sequence = 0
-                self.next_song_sequence()
+            elif self.pattern_chain:
+                self.chain_position = (self.chain_position + 1) % len(self.pattern_chain)
+            self.enter_sequence()
+        self.resolve_events()
+        self.step_clock = (self.step_clock[1], played_pattern, played_step, step_time, self.pending_pattern)
 
-    def play_midi_on(self, channel, note):
+    def resolve_events(self):
+        """Resolve the (track, channel, note, velocity) events for the current step, a note of 0 only silences the track."""
+        if self.pattern_index is None:
+            self.pending_pattern = self.controller.get_current_pattern_index()
+        else:
+            self.pending_pattern = self.pattern_index
+        pattern = self.controller.get_pattern_at(self.pending_pattern)
+        velocities = self.controller.get_velocities_at(self.pending_pattern)
+        events = []
+        for track in range(10):
+            value = pattern[track][self.current_step]
+            if track < 5:
+                if value > 0:
+                    channel = self.channel
+                    enabled = self.mask & 2 > 0
+                    if track == 0:
+                        channel = 3
+                        enabled = self.mask & 1 > 0
+                    if value < 128 and enabled:
+                        events.append((track, channel, value, velocities[track][self.current_step]))
+                    else:
+                        events.append((track, channel, 0, 0))
+            elif value == 1:
+                enabled = (self.mask & 4 > 0 and track == 5) or (self.mask & 8 > 0 and track > 5)
+                if enabled:
+                    events.append((track, 9, self.midi_notes[track], velocities[track][self.current_step]))
+                else:
+                    events.append((track, 9, 0, 0))
+        self.pending_events = events
+        self.resolve_automation()
+
+    def resolve_automation(self):
+        """Resolve the CC values for the current step, keeping only values that changed."""
+        key = (self.pending_pattern, self.controller.get_automation_version())
+        if key != self.compiled_key:
+            # Lanes are only interpolated again when the pattern or its automation changes
+            self.compiled_automation = self.controller.compile_automation(self.pending_pattern)
+            self.compiled_key = key
+        changes = []
+        for channel, control, values in self.compiled_automation:
+            value = values[self.current_step]
+            if self.last_cc.get((channel, control)) != value:
+                self.last_cc[(channel, control)] = value
+                changes.append((channel, control, value))
+        self.pending_cc = changes
+
+    def play_midi_on(self, channel, note, velocity=127):
         """Send a MIDI note-on and note-off message for the given note."""
-        self.midi_out.note_on(note, 127, channel)  # Channel 10 is index 9
+        self.midi_out.note_on(note, velocity, channel)  # Channel 10 is index 9
 
     def play_midi_off(self, channel, note):
         self.midi_out.note_off(note, 127, channel)
@@ -175,4 +272,146 @@ class MidiPlayer:
             self.midi_out.write([[[0xB0 + (channel - 1), control, msg], pygame.midi.time()]])
 
     def set_signal(self, song_position_signal):
-        self.song_position_signal = song_position_signal
\ No newline at end of file
+        self.song_position_signal = song_position_signal
+
+class MidiRecorder:
+    def __init__(self, controller, midi_player):
+        self.controller = controller
+        self.midi_player = midi_player  # Playback clock to quantize against
+        self.is_recording = False
+        self.record_thread = None
+        self.midi_in = None
+        self.device_id = pygame.midi.get_default_input_id()
+        self.record_track = 0  # Track for incoming notes that are not drum notes
+        self.held_notes = {}  # Note number -> (pattern, step) it was recorded at
+        self.recorded_signal = None
+
+        # Incoming notes on channel 10 that match a drum note are recorded on that drum track
+        self.drum_tracks = {note: track for track, note in midi_player.midi_notes.items() if note is not None}
+
+    def get_input_devices(self):
+        device_names = []
+        for device_id in range(pygame.midi.get_count()):
+            info = pygame.midi.get_device_info(device_id)
+            # info[2] indicates if it's an input device (1 for input)
+            if info[2] == 1:
+                device_names.append(info[1].decode())
+        return device_names
+
+    def set_input_device(self, device_name):
+        self.stop()
+        for device_id in range(pygame.midi.get_count()):
+            info = pygame.midi.get_device_info(device_id)
+            if info[1].decode() == device_name and info[2] == 1:  # Input device
+                self.device_id = device_id
+                break
+
+    def set_record_track(self, track):
+        self.record_track = track
+
+    def get_input_device(self):
+        """Return the name of the selected input device, or None if there is none."""
+        if self.device_id < 0:
+            return None
+        return pygame.midi.get_device_info(self.device_id)[1].decode()
+
+    def start(self):
+        """Open the input device and start reading it in a separate thread, returns False if it can't be opened."""
+        if self.is_recording:
+            return True
+        if self.device_id < 0:
+            return False
+        try:
+            self.midi_in = pygame.midi.Input(self.device_id)
+        except pygame.midi.MidiException as e:
+            # Busy or unplugged devices fail here
+            print(f"Could not open MIDI input: {e}")
+            return False
+        self.held_notes = {}
+        self.is_recording = True
+        self.record_thread = threading.Thread(target=self.record_loop)
+        self.record_thread.start()
+        return True
+
+    def stop(self):
+        """Stop recording and close the input device."""
+        self.is_recording = False
+        if self.record_thread is not None:
+            self.record_thread.join()
+            self.record_thread = None
+        if self.midi_in:
+            self.midi_in.close()
+            self.midi_in = None
+
+    def record_loop(self):
+        """Read input events in batches and write them into the pattern."""
+        while self.is_recording:
+            if not self.midi_in.poll():
+                time.sleep(0.002)
+                continue
+            batch = []
+            for (status, note, velocity, _), timestamp in self.midi_in.read(64):
+                message = status & 0xF0
+                if message == 0x90 and velocity > 0:
+                    # Notes are only recorded while the sequencer runs, the step grid comes from its clock
+                    if self.midi_player.is_playing:
+                        self.record_note_on(batch, status & 0x0F, note, velocity, timestamp)
+                elif message == 0x80 or message == 0x90:
+                    self.record_note_off(batch, note, timestamp)
+            if batch:
+                self.write_batch(batch)
+
+    def quantize(self, timestamp):
+        """Round a pygame.midi.time() timestamp to the nearest (pattern, step) of the playing loop."""
+        previous_pattern, pattern, step, step_time, next_pattern = self.midi_player.step_clock
+        step = step + round((timestamp - step_time) / self.midi_player.step_ms)
+        loop_start = self.midi_player.loop_start
+        loop_end = self.midi_player.loop_end
+        if step >= loop_end:
+            # Rounded past the loop end, the note belongs to the start of the next pattern
+            pattern = next_pattern
+        elif step < loop_start:
+            # Read late (e.g. the thread was starved), the note belongs to the end of the previous pattern
+            pattern = previous_pattern
+        return pattern, loop_start + (step - loop_start) % (loop_end - loop_start)
+
+    def record_note_on(self, batch, channel, note, velocity, timestamp):
+        pattern, step = self.quantize(timestamp)
+        if channel == 9 and note in self.drum_tracks:
+            batch.append((pattern, self.drum_tracks[note], step, 1, velocity))
+        else:
+            batch.append((pattern, self.record_track, step, note, velocity))
+            self.held_notes[note] = (pattern, step)
+
+    def record_note_off(self, batch, note, timestamp):
+        # A released note becomes a REST, unless it is released on the step it started on.
+        # Releases are always tracked, so a key let go after playback stops is not held forever
+        if note not in self.held_notes:
+            return
+        start = self.held_notes.pop(note)
+        if not self.midi_player.is_playing:
+            return
+        pattern, step = self.quantize(timestamp)
+        if (pattern, step) != start and not self.held_notes:
+            batch.append((pattern, self.record_track, step, 128, None))
+
+    @traced('record')
+    def write_batch(self, batch):
+        """Write a batch of (pattern, track, step, note, velocity) events and notify the UI once."""
+        for pattern_index, track, step, note, velocity in batch:
+            pattern = self.controller.get_pattern_at(pattern_index)
+            if track > 4:
+                # Drum steps toggle, so only set the ones that are not already set
+                if pattern[track][step] == 0:
+                    self.controller.add_note_to_track(track, step, note, velocity, pattern_index)
+            elif note != 128 or pattern[track][step] == 0:
+                self.controller.add_note_to_track(track, step, note, velocity, pattern_index)
+        if self.recorded_signal is not None:
+            self.recorded_signal.emit()
+
+    def close(self):
+        """Stop recording and release the input device."""
+        self.stop()
+
+    def set_signal(self, recorded_signal):
+        self.recorded_signal = recorded_signal
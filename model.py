@@ -1,3 +1,11 @@
+import random
+
+from profiling import traced
+
+
+NO_POINT = 255  # Automation lane step without a point
+
+
 class TrackerPattern:
     def __init__(self, num_tracks=10, num_steps=64, num_patterns=4):
         self.num_tracks = num_tracks
@@ -5,6 +13,11 @@ class TrackerPattern:
         self.num_patterns = num_patterns
         # Initialize multiple patterns (each pattern is a list of tracks and steps)
         self.patterns = [[[0 for _ in range(num_steps)] for _ in range(num_tracks)] for _ in range(num_patterns)]
+        # Per step velocity (0-127) as one compact byte column next to each track
+        self.velocities = [[bytearray([127] * num_steps) for _ in range(num_tracks)] for _ in range(num_patterns)]
+        # CC automation lanes per pattern, each a byte column of points where NO_POINT leaves the step empty
+        self.automation = [[] for _ in range(num_patterns)]
+        self.automation_version = 0  # Bumped on every lane change so compiled lanes can be reused
         self.current_pattern_index = 0  # Start with the first pattern
         self.metadata = {
             'bpm': 120,  # Default BPM value
@@ -19,26 +32,40 @@ class TrackerPattern:
     def set_bpm(self, bpm):
         self.metadata['bpm'] = bpm
 
-    def toggle_step(self, track, step):
-        """Toggle a step (mark/unmark) in the drum pattern for the current pattern."""
+    @traced('model')
+    def toggle_step(self, track, step, pattern_index=None):
+        """Toggle a step (mark/unmark) in the drum pattern for the current pattern (or the given one)."""
+        if pattern_index is None:
+            pattern_index = self.current_pattern_index
         if track > 4:
-            self.patterns[self.current_pattern_index][track][step] = 1 - self.patterns[self.current_pattern_index][track][step]
+            self.patterns[pattern_index][track][step] = 1 - self.patterns[pattern_index][track][step]
 
     def get_pattern(self):
         """Return the current pattern."""
         return self.patterns[self.current_pattern_index]
 
+    def get_pattern_at(self, index):
+        """Return the pattern at the given index."""
+        return self.patterns[index]
+
+    def get_current_pattern_index(self):
+        """Return the index of the current pattern."""
+        return self.current_pattern_index
+
     def set_pattern(self, pattern):
         """Set the current pattern."""
         self.patterns[self.current_pattern_index] = pattern
 
-    def set_note_for_track(self, track, step, note):
-        """Set a MIDI note for the specified track and step."""
+    @traced('model')
+    def set_note_for_track(self, track, step, note, pattern_index=None):
+        """Set a MIDI note for the specified track and step of the current pattern (or the given one)."""
+        if pattern_index is None:
+            pattern_index = self.current_pattern_index
         if track > 4:
-            self.toggle_step(track, step)
+            self.toggle_step(track, step, pattern_index)
         else:
-            self.patterns[self.current_pattern_index][track][step] = note
-        return self.patterns[self.current_pattern_index]
+            self.patterns[pattern_index][track][step] = note
+        return self.patterns[pattern_index]
 
     def set_current_pattern(self, index):
         """Set the current pattern to a specified index."""
@@ -47,6 +74,139 @@ class TrackerPattern:
         else:
             raise ValueError("Pattern index out of range")
 
+    def get_velocities_at(self, index):
+        """Return the velocity columns of the pattern at the given index."""
+        return self.velocities[index]
+
+    @traced('model')
+    def set_velocity(self, track, step, velocity, pattern_index=None):
+        """Set the velocity of a step in the current pattern (or the given one)."""
+        if pattern_index is None:
+            pattern_index = self.current_pattern_index
+        # Velocity 0 would turn the note-on into a note-off
+        self.velocities[pattern_index][track][step] = min(max(velocity, 1), 127)
+
+    @traced('model')
+    def set_automation_point(self, control, step, value, channel=3):
+        """Set (or clear with None) an automation point for a CC on the current pattern."""
+        lanes = self.automation[self.current_pattern_index]
+        lane = next((lane for lane in lanes if lane['control'] == control and lane['channel'] == channel), None)
+        if lane is None:
+            if value is None:
+                return
+            lane = {'channel': channel, 'control': control, 'points': bytearray([NO_POINT] * self.num_steps)}
+            lanes.append(lane)
+        lane['points'][step] = NO_POINT if value is None else min(max(value, 0), 127)
+        self.automation_version += 1
+
+    def get_automation_points(self, control, channel=3):
+        """Return the point column of a CC lane on the current pattern, or None if there is no lane."""
+        for lane in self.automation[self.current_pattern_index]:
+            if lane['control'] == control and lane['channel'] == channel:
+                return lane['points']
+        return None
+
+    def get_automation_version(self):
+        return self.automation_version
+
+    def compile_automation(self, index):
+        """Interpolate the lanes of a pattern into (channel, control, values per step) columns."""
+        compiled = []
+        for lane in self.automation[index]:
+            points = [(step, value) for step, value in enumerate(lane['points']) if value != NO_POINT]
+            if not points:
+                continue
+            # Hold the first and last value before and after the points, ramp linearly in between
+            values = bytearray([points[0][1]] * self.num_steps)
+            for (step, value), (next_step, next_value) in zip(points, points[1:]):
+                for i in range(step, next_step):
+                    values[i] = value + (next_value - value) * (i - step) // (next_step - step)
+            values[points[-1][0]:] = bytes([points[-1][1]]) * (self.num_steps - points[-1][0])
+            compiled.append((lane['channel'], lane['control'], values))
+        return compiled
+
+    # Bulk transforms, each rewrites whole track rows of the current pattern in one pass
+    @traced('model')
+    def transpose(self, semitones, tracks, start=0, end=None):
+        """Transpose the notes of the voice/chord tracks in steps start..end-1, keeping rests.
+
+        Nothing changes (and False is returned) if any note would leave the MIDI range 1-127.
+        """
+        pattern = self.patterns[self.current_pattern_index]
+        end = self.num_steps if end is None else end
+        tracks = [track for track in tracks if track < 5]
+        for track in tracks:
+            for note in pattern[track][start:end]:
+                if 0 < note < 128 and not 0 < note + semitones < 128:
+                    return False
+        for track in tracks:
+            row = pattern[track]
+            row[start:end] = [note + semitones if 0 < note < 128 else note for note in row[start:end]]
+        return True
+
+    @traced('model')
+    def rotate(self, steps, tracks, start=0, end=None):
+        """Rotate steps start..end-1 of the given tracks later by steps (earlier if negative)."""
+        pattern = self.patterns[self.current_pattern_index]
+        end = self.num_steps if end is None else end
+        length = end - start
+        if length <= 0:
+            return
+        steps = steps % length
+        velocities = self.velocities[self.current_pattern_index]
+        for track in tracks:
+            for row in (pattern[track], velocities[track]):
+                block = row[start:end]
+                row[start:end] = block[length - steps:] + block[:length - steps]
+
+    def copy_block(self, tracks, start=0, end=None):
+        """Return a copy of the notes and velocities in steps start..end-1 of the given tracks."""
+        pattern = self.patterns[self.current_pattern_index]
+        velocities = self.velocities[self.current_pattern_index]
+        end = self.num_steps if end is None else end
+        return [(track, pattern[track][start:end], velocities[track][start:end]) for track in tracks]
+
+    @traced('model')
+    def paste_block(self, block, step, track_offset=0, pattern_index=None):
+        """Paste a copied block at step, into another pattern if pattern_index is given."""
+        if pattern_index is None:
+            pattern_index = self.current_pattern_index
+        pattern = self.patterns[pattern_index]
+        velocities = self.velocities[pattern_index]
+        for track, values, block_velocities in block:
+            track = track + track_offset
+            # Notes and drum hits are not interchangeable, so a block only pastes onto the same kind of track
+            if not 0 <= track < self.num_tracks or (track > 4) != (track - track_offset > 4):
+                continue
+            values = values[:self.num_steps - step]
+            pattern[track][step:step + len(values)] = values
+            velocities[track][step:step + len(values)] = block_velocities[:len(values)]
+
+    @traced('model')
+    def euclidean_fill(self, track, pulses, length=16, rotation=0):
+        """Fill a drum track with pulses hits spread as evenly as possible over every length steps."""
+        if track < 5:
+            raise ValueError("Euclidean fill only applies to drum tracks")
+        if length <= 0:
+            raise ValueError("Length must be positive")
+        if not 0 <= pulses <= length:
+            raise ValueError("Pulses out of range")
+        rhythm = [1 if (step * pulses) % length < pulses else 0 for step in range(length)]
+        rotation = rotation % length
+        rhythm = rhythm[length - rotation:] + rhythm[:length - rotation]
+        self.patterns[self.current_pattern_index][track] = [rhythm[step % length] for step in range(self.num_steps)]
+
+    @traced('model')
+    def humanize(self, tracks, start=0, end=None, amount=16, seed=None):
+        """Randomize velocities in steps start..end-1 by up to amount either way."""
+        rng = random.Random(seed)
+        velocities = self.velocities[self.current_pattern_index]
+        end = self.num_steps if end is None else end
+        for track in tracks:
+            row = velocities[track]
+            row[start:end] = bytes(min(max(velocity + rng.randint(-amount, amount), 1), 127)
+                                   for velocity in row[start:end])
+
     # Song-related methods
     def get_song_data(self):
         """Return all patterns and metadata for saving."""
@@ -55,8 +215,12 @@ class TrackerPattern:
             'metadata': self.metadata,
             'pattern_sequence': self.pattern_sequence,
             'track_masks': self.track_masks,
+            'velocities': [[list(row) for row in pattern] for pattern in self.velocities],
+            'automation': [[{'channel': lane['channel'], 'control': lane['control'], 'points': list(lane['points'])}
+                            for lane in lanes] for lanes in self.automation],
         }
 
+    @traced('model')
     def set_song_data(self, data):
         """Load song data including all patterns and metadata."""
         self.patterns = data['patterns']
@@ -64,12 +228,26 @@ class TrackerPattern:
         if 'pattern_sequence' in data:
             self.pattern_sequence = data['pattern_sequence']
             self.track_masks = data['track_masks']
+        # Songs saved before velocities and automation existed play at full velocity without automation
+        if 'velocities' in data:
+            self.velocities = [[bytearray(row) for row in pattern] for pattern in data['velocities']]
+        else:
+            self.velocities = [[bytearray([127] * len(row)) for row in pattern] for pattern in self.patterns]
+        if 'automation' in data:
+            self.automation = [[{'channel': lane['channel'], 'control': lane['control'],
+                                 'points': bytearray(lane['points'])} for lane in lanes]
+                               for lanes in data['automation']]
+        else:
+            self.automation = [[] for _ in self.patterns]
+        self.automation_version += 1
 
+    @traced('model')
     def set_pattern_sequence(self, index, pattern_index):
         """Set a pattern in the sequence (index 0-9)."""
         if 0 <= index < 10:
             self.pattern_sequence[index] = pattern_index
 
+    @traced('model')
     def set_track_mask(self, index, mask, value):
         """Set the 4-bit track mask for a particular pattern in the sequence."""
         if 0 <= index < 10:
@@ -0,0 +1,56 @@
+import functools
+import json
+import os
+import threading
+import time
+
+# Tracing is opt-in: set MIDITRACKER_TRACE to the file the trace should be written to.
+# It is read once at import, so with tracing off @traced returns functions unchanged.
+TRACE_PATH = os.environ.get('MIDITRACKER_TRACE')
+enabled = bool(TRACE_PATH)
+
+_events = []  # Chrome trace-event dicts, list.append is atomic so all threads can record
+_thread_names = {}
+_pid = os.getpid()
+
+
+def _now_us():
+    return time.perf_counter_ns() // 1000
+
+
+def _record(name, category, start_us):
+    tid = threading.get_ident()
+    if tid not in _thread_names:
+        _thread_names[tid] = threading.current_thread().name
+    _events.append({'name': name, 'cat': category, 'ph': 'X', 'ts': start_us,
+                    'dur': _now_us() - start_us, 'pid': _pid, 'tid': tid})
+
+
+def traced(category, name=None):
+    """Decorator recording each call as a span, a no-op when tracing is disabled."""
+    def decorator(func):
+        if not enabled:
+            return func
+        span_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start_us = _now_us()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _record(span_name, category, start_us)
+        return wrapper
+    return decorator
+
+
+def export(path=None):
+    """Write the recorded spans as Chrome trace-event JSON (chrome://tracing, Perfetto)."""
+    path = path or TRACE_PATH
+    if not enabled or not path:
+        return
+    metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': _pid, 'tid': tid, 'args': {'name': thread_name}}
+                for tid, thread_name in list(_thread_names.items())]
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': metadata + list(_events), 'displayTimeUnit': 'ms'}, f)
+    print(f"Trace written to {path}")
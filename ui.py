@@ -1,9 +1,14 @@
 # ui.py (continued)
 
+import threading
 from PyQt5.QtWidgets import QMainWindow, QTableWidget, QVBoxLayout, QPushButton, QWidget, QTableWidgetItem, QFileDialog
-from PyQt5.QtWidgets import QHBoxLayout, QComboBox, QLabel, QSpinBox
+from PyQt5.QtWidgets import QHBoxLayout, QComboBox, QLabel, QSpinBox, QLineEdit, QDialog, QListWidget
+from PyQt5.QtWidgets import QInputDialog
 from PyQt5.QtGui import QFontDatabase, QFont, QPalette, QColor
-from PyQt5.QtCore import pyqtSignal
+from PyQt5.QtCore import pyqtSignal, Qt
+from library import SongLibrary, thumbnail_text
+from model import NO_POINT
+from profiling import traced
 
 def midi_to_note_name(midi_note):
     """Convert a MIDI note number (0-127) to a note name."""
@@ -16,20 +21,97 @@ def midi_to_note_name(midi_note):
     note = midi_note % 12  # Get the note within the octave
     return f"{note_names[note]}{octave}"
 
+class LibraryDialog(QDialog):
+    """Search the song library index and preview songs without opening them."""
+    scanned_signal = pyqtSignal()
+
+    def __init__(self, library, font, parent=None):
+        super().__init__(parent)
+        self.scanned_signal.connect(self.finish_scan)
+        self.setWindowTitle('Song Library (scanning)')
+        self.library = library
+        self.selected_song = None
+
+        layout = QVBoxLayout()
+        self.search_input = QLineEdit()
+        self.search_input.setFont(font)
+        self.search_input.setPlaceholderText("Search")
+        self.search_input.textChanged.connect(self.update_results)
+        layout.addWidget(self.search_input)
+
+        self.results = QListWidget()
+        self.results.setFont(font)
+        self.results.currentTextChanged.connect(self.update_preview)
+        self.results.itemDoubleClicked.connect(self.accept_song)
+        layout.addWidget(self.results)
+
+        self.preview = QLabel()
+        self.preview.setFont(font)
+        layout.addWidget(self.preview)
+        self.setLayout(layout)
+        self.update_results()
+
+        # Show the stored index right away and refresh once the scan off the UI thread is done
+        threading.Thread(target=self.scan, daemon=True).start()
+
+    def scan(self):
+        # Always report back, otherwise a failed scan leaves the dialog waiting forever
+        try:
+            self.library.scan()
+        finally:
+            try:
+                self.scanned_signal.emit()
+            except RuntimeError:
+                # The dialog was closed and deleted before the scan finished
+                pass
+
+    def finish_scan(self):
+        self.setWindowTitle('Song Library')
+        self.update_results()
+
+    def update_results(self):
+        selected = self.results.currentItem().text() if self.results.currentItem() else None
+        self.results.clear()
+        self.results.addItems(self.library.search(self.search_input.text()))
+        if selected is not None:
+            matches = self.results.findItems(selected, Qt.MatchExactly)
+            if matches:
+                self.results.setCurrentItem(matches[0])
+
+    def update_preview(self, name):
+        if not name:
+            self.preview.setText("")
+            return
+        song = self.library.get_song(name)
+        sequence = ' '.join(f"P{p}" for p in song['pattern_sequence'][:8])
+        self.preview.setText(f"BPM {song['bpm']}  {sequence}  {song['note_density']:.0%}\n"
+                             f"{thumbnail_text(song['thumbnail'], song['pattern_sequence'][0] - 1)}")
+
+    def accept_song(self, item):
+        self.selected_song = item.text()
+        self.accept()
+
+
 class TrackerApp(QMainWindow):
     song_position_signal = pyqtSignal(str)
+    recorded_signal = pyqtSignal()
 
-    def __init__(self, controller, midi_player):
+    def __init__(self, controller, midi_player, midi_recorder):
         super().__init__()
         self.song_position_signal.connect(self.handle_position_update)
+        self.recorded_signal.connect(self.update_grid)
         self.setWindowTitle('90s Sound Tracker')
         self.controller = controller
         self.midi_player = midi_player  # Pass the player to the UI
         self.midi_player.set_signal(self.song_position_signal)
+        self.midi_recorder = midi_recorder
+        self.midi_recorder.set_signal(self.recorded_signal)
         self.current_octave = 4  # Default octave is 4
         self.cursor_track = 0
         self.cursor_step = 0
         self.current_pattern = 0
+        self.clipboard = None  # Block copied with Ctrl+C
+        self.row_labels = None  # Row header labels currently shown
 
         # Mapping of keys to relative note positions (semitones)
         self.key_to_note = {
@@ -83,6 +165,62 @@ class TrackerApp(QMainWindow):
         bpm_layout.setStretch(3, 1)
         self.bpm_input.valueChanged.connect(self.update_bpm)
 
+        # Velocity used for notes entered from the keyboard
+        velocity_label = QLabel("Vel:")
+        velocity_label.setFont(self.c64_font)
+        self.velocity_input = QSpinBox()
+        self.velocity_input.setFont(self.c64_font)
+        self.velocity_input.setRange(1, 127)
+        self.velocity_input.setValue(127)
+        bpm_layout.addWidget(velocity_label)
+        bpm_layout.addWidget(self.velocity_input)
+
+        # Add loop region control
+        loop_label = QLabel("Loop:")
+        loop_label.setFont(self.c64_font)
+        self.loop_start_input = QSpinBox()
+        self.loop_start_input.setFont(self.c64_font)
+        self.loop_start_input.setRange(1, 64)
+        self.loop_start_input.setValue(1)
+        self.loop_end_input = QSpinBox()
+        self.loop_end_input.setFont(self.c64_font)
+        self.loop_end_input.setRange(1, 64)
+        self.loop_end_input.setValue(64)
+        bpm_layout.addWidget(loop_label)
+        bpm_layout.addWidget(self.loop_start_input)
+        bpm_layout.addWidget(self.loop_end_input)
+        self.loop_start_input.valueChanged.connect(self.update_loop)
+        self.loop_end_input.valueChanged.connect(self.update_loop)
+
+        # CC automation: points are set on (or cleared from) the selected steps, the row headers show them
+        automation_layout = QHBoxLayout()
+        cc_label = QLabel("CC:")
+        cc_label.setFont(self.c64_font)
+        self.cc_input = QSpinBox()
+        self.cc_input.setFont(self.c64_font)
+        self.cc_input.setRange(0, 127)
+        self.cc_input.setValue(70)  # The CC the player already sends on start
+        self.cc_input.valueChanged.connect(lambda _: self.update_grid())
+        cc_value_label = QLabel("Value:")
+        cc_value_label.setFont(self.c64_font)
+        self.cc_value_input = QSpinBox()
+        self.cc_value_input.setFont(self.c64_font)
+        self.cc_value_input.setRange(0, 127)
+        self.set_cc_button = QPushButton('Set CC')
+        self.set_cc_button.setFont(self.c64_font)
+        self.set_cc_button.setStyleSheet("QPushButton { background-color: green; color: black; }")
+        self.set_cc_button.clicked.connect(lambda: self.set_automation(self.cc_value_input.value()))
+        self.clear_cc_button = QPushButton('Clear CC')
+        self.clear_cc_button.setFont(self.c64_font)
+        self.clear_cc_button.setStyleSheet("QPushButton { background-color: green; color: black; }")
+        self.clear_cc_button.clicked.connect(lambda: self.set_automation(None))
+        automation_layout.addWidget(cc_label)
+        automation_layout.addWidget(self.cc_input)
+        automation_layout.addWidget(cc_value_label)
+        automation_layout.addWidget(self.cc_value_input)
+        automation_layout.addWidget(self.set_cc_button)
+        automation_layout.addWidget(self.clear_cc_button)
+
         # Create a horizontal layout for the Save and Load buttons
         button_layout = QHBoxLayout()
 
@@ -121,7 +259,14 @@ class TrackerApp(QMainWindow):
 
         button_layout.addWidget(self.play_button)
         button_layout.addWidget(self.song_button)
+        self.record_button = QPushButton('Rec')
+        self.record_button.setStyleSheet("QPushButton { background-color: green; color: black; }")
+        self.record_button.setFont(self.c64_font)
+        self.record_button.setCheckable(True)
+        self.record_button.clicked.connect(self.toggle_recording)
+
         button_layout.addWidget(self.stop_button)
+        button_layout.addWidget(self.record_button)
 
         # Add this to the init method in TrackerApp, before setting the central widget
         pattern_layout = QHBoxLayout()
@@ -135,6 +280,14 @@ class TrackerApp(QMainWindow):
                 lambda _, index=i: self.switch_pattern(index))  # Connect button click to switch_pattern
             pattern_layout.addWidget(button)
 
+        # Pattern chain for Play, e.g. 1123 plays P1, P1, P2, P3 and repeats
+        self.chain_input = QLineEdit()
+        self.chain_input.setFont(self.c64_font)
+        self.chain_input.setPlaceholderText("Chain")
+        self.chain_input.setFixedWidth(100)
+        self.chain_input.editingFinished.connect(self.update_chain)
+        pattern_layout.addWidget(self.chain_input)
+
         # Add pattern layout to the main layout
         layout.addLayout(pattern_layout)
 
@@ -185,13 +338,20 @@ class TrackerApp(QMainWindow):
         self.load_button.setFont(self.c64_font)
 
         button_layout.addWidget(self.save_button)
+        self.library_button = QPushButton('Library')
+        self.library_button.setStyleSheet("QPushButton { background-color: green; color: black; }")
+        self.library_button.setFont(self.c64_font)
+
         button_layout.addWidget(self.load_button)
+        button_layout.addWidget(self.library_button)
 
         # Connect buttons to their respective functions
         self.save_button.clicked.connect(self.save_song)
         self.load_button.clicked.connect(self.load_song)
+        self.library_button.clicked.connect(self.open_library)
 
         layout.addLayout(bpm_layout)
+        layout.addLayout(automation_layout)
         layout.addLayout(button_layout)
 
         # Create a dropdown menu (QComboBox) for MIDI output devices
@@ -206,6 +366,20 @@ class TrackerApp(QMainWindow):
 
         layout.addWidget(self.midi_device_dropdown)
 
+        # Create a dropdown menu for MIDI input devices used for recording
+        self.midi_input_dropdown = QComboBox()
+        self.midi_input_dropdown.setFont(self.c64_font)
+        self.midi_input_dropdown.addItems(self.midi_recorder.get_input_devices())
+        # Show the device the recorder actually uses, or make the listed one the recorder's device
+        input_device = self.midi_recorder.get_input_device()
+        if input_device is not None and self.midi_input_dropdown.findText(input_device) != -1:
+            self.midi_input_dropdown.setCurrentIndex(self.midi_input_dropdown.findText(input_device))
+        elif self.midi_input_dropdown.count() > 0:
+            self.midi_recorder.set_input_device(self.midi_input_dropdown.currentText())
+        self.midi_input_dropdown.currentIndexChanged.connect(self.on_input_device_selected)
+
+        layout.addWidget(self.midi_input_dropdown)
+
         self.setLayout(layout)
 
         # Set the minimum size of the window based on your layout needs
@@ -230,6 +404,18 @@ class TrackerApp(QMainWindow):
             self.controller.load_song(file_path)
         self.update_grid()
 
+    def open_library(self):
+        directory = QFileDialog.getExistingDirectory(self, "Song Library")
+        if not directory:
+            return
+        library = SongLibrary(directory)
+        dialog = LibraryDialog(library, self.c64_font, self)
+        accepted = dialog.exec_() == QDialog.Accepted
+        selected_song = dialog.selected_song
+        dialog.deleteLater()  # Parented to the window, so it would otherwise live until exit
+        if accepted and selected_song:
+            self.controller.load_song(library.get_path(selected_song))
+            self.update_grid()
 
     def next_step(self):
         self.cursor_step = self.cursor_step + 1
@@ -237,11 +423,15 @@ class TrackerApp(QMainWindow):
             self.cursor_step = 0
         self.grid.setCurrentCell(self.cursor_step, self.cursor_track)
 
+    @traced('ui')
     def keyPressEvent(self, event):
         """Handle key press events for note entry."""
         self.cursor_track = self.grid.currentColumn()
         self.cursor_step = self.grid.currentRow()
         key = event.text()
+        if self.handle_transform_key(event):
+            self.update_grid()
+            return
         if key == "":
             super().keyPressEvent(event)
             return
@@ -266,7 +456,7 @@ class TrackerApp(QMainWindow):
             # Calculate the MIDI note based on the current octave and key
             note = (self.current_octave * 12) + self.key_to_note[key]
             # Add the note to the main voice track
-            self.controller.add_note_to_track(self.cursor_track, self.cursor_step, note)
+            self.controller.add_note_to_track(self.cursor_track, self.cursor_step, note, self.velocity_input.value())
             self.next_step()
 
             # Optional: Play the note immediately for feedback
@@ -275,26 +465,83 @@ class TrackerApp(QMainWindow):
         super().keyPressEvent(event)
         self.update_grid()
 
+    def selection(self):
+        """Return the selected tracks and step range (end exclusive), or the cursor cell."""
+        ranges = self.grid.selectedRanges()
+        if not ranges:
+            return [self.cursor_track], self.cursor_step, self.cursor_step + 1
+        selected = ranges[0]
+        tracks = list(range(selected.leftColumn(), selected.rightColumn() + 1))
+        return tracks, selected.topRow(), selected.bottomRow() + 1
+
+    @traced('ui')
+    def handle_transform_key(self, event):
+        """Apply a bulk transform to the selection, returns True if the key was handled."""
+        tracks, start, end = self.selection()
+        if event.modifiers() & Qt.ControlModifier:
+            if event.key() == Qt.Key_C:
+                self.clipboard = (tracks[0], self.controller.copy_block(tracks, start, end))
+                return False
+            if event.key() == Qt.Key_V and self.clipboard:
+                first_track, block = self.clipboard
+                self.controller.paste_block(block, start, tracks[0] - first_track)
+                return True
+            return False
+        key = event.text()
+        if key in ('+', '-'):
+            self.controller.transpose(1 if key == '+' else -1, tracks, start, end)
+        elif key in ('<', '>'):
+            # Shift the whole track when a single cell is selected
+            if end - start == 1:
+                start, end = 0, 64
+            self.controller.rotate(1 if key == '>' else -1, tracks, start, end)
+        elif key == 'r':
+            self.controller.humanize(tracks, start, end)
+        elif key == 'e':
+            drum_tracks = [track for track in tracks if track > 4]
+            if not drum_tracks:
+                return False
+            pulses, ok = QInputDialog.getInt(self, "Euclidean Fill", "Hits per 16 steps:", 4, 0, 16)
+            if not ok:
+                return False
+            for track in drum_tracks:
+                self.controller.euclidean_fill(track, pulses)
+        else:
+            return False
+        return True
+
+    @traced('ui')
     def update_grid(self):
         """Update the table to display the current pattern."""
         pattern = self.controller.get_pattern()
+        velocities = self.controller.get_velocities_at(self.controller.get_current_pattern_index())
 
         for row in range(64):  # 64 steps
             for col in range(10):  # 10 tracks
                 if col < 5:
                     # Voice and chord tracks: display note names
-                    midi_note = pattern[col][row]
-                    note_name = midi_to_note_name(midi_note)  # Convert MIDI note to note name
-                    item = QTableWidgetItem(note_name)
-                    self.grid.setItem(row, col, item)
-
-                else:
+                    text = midi_to_note_name(pattern[col][row])  # Convert MIDI note to note name
+                elif pattern[col][row] == 1:
                     # Drum tracks: display 'X' if the value is 1
-                    value = pattern[col][row]
-                    if value == 1:
-                        self.grid.setItem(row, col, QTableWidgetItem("X"))
-                    else:
-                        self.grid.setItem(row, col, QTableWidgetItem(""))
+                    text = "X"
+                else:
+                    text = ""
+                # Show the velocity next to notes that are not played at full velocity
+                if 0 < pattern[col][row] < 128 and velocities[col][row] < 127:
+                    text = f"{text} {velocities[col][row]}"
+                # Only touch cells whose text changed, so pattern switches during playback stay cheap
+                item = self.grid.item(row, col)
+                if item is None:
+                    self.grid.setItem(row, col, QTableWidgetItem(text))
+                elif item.text() != text:
+                    item.setText(text)
+        # Row headers show the points of the selected CC lane
+        points = self.controller.get_automation_points(self.cc_input.value())
+        labels = [str(row + 1) if points is None or points[row] == NO_POINT else f"{row + 1}:{points[row]}"
+                  for row in range(64)]
+        if labels != self.row_labels:
+            self.row_labels = labels
+            self.grid.setVerticalHeaderLabels(labels)
         self.bpm_input.setValue(self.controller.get_bpm())
         pattern_sequence = self.controller.get_pattern_sequence()
         for i in self.pattern_buttons:
@@ -311,6 +558,7 @@ class TrackerApp(QMainWindow):
     def toggle_step(self, row, col):
         if col < 5:
             self.cursor_track = col
+            self.midi_recorder.set_record_track(col)
         self.cursor_step = row
 
         """Notify the controller to toggle the step in the model."""
@@ -331,6 +579,7 @@ class TrackerApp(QMainWindow):
 
     def closeEvent(self, event):
         """Handle the window close event."""
+        self.midi_recorder.close()  # Stop recording before MIDI is shut down
         self.midi_player.stop()  # Ensure playback is stopped
         self.midi_player.close()  # Close MIDI resources
         event.accept()  # Allow the window to close
@@ -347,6 +596,10 @@ class TrackerApp(QMainWindow):
         # Get the selected device name from the dropdown
         selected_device = self.midi_device_dropdown.itemText(index)
 
+        # Switching output restarts pygame.midi, which also closes the input
+        self.record_button.setChecked(False)
+        self.midi_recorder.stop()
+
         # Pass the selected device to the controller
         self.midi_player.set_output_device(selected_device)
 
@@ -397,16 +650,46 @@ class TrackerApp(QMainWindow):
             self.controller.set_track_mask(pattern_index, mask, 1)
 
 
+    @traced('ui')
     def handle_position_update(self, position):
-        self.position_label.setText(position)
-        # position_string is in the format <song_sequence>/<step_number>
-        song_sequence, step_number = map(int, position.split('/'))
+        # position_string is in the format <song_sequence>/<step_number>/<pattern_index>
+        song_sequence, step_number, pattern = map(int, position.split('/'))
+        self.position_label.setText(f"{song_sequence}/{step_number}")
         self.grid.setCurrentCell(step_number, self.cursor_track)
-        # Update the song sequence only if it changes
-        if song_sequence == -1:
-            return
-        pattern = self.controller.get_pattern_sequence()[song_sequence] - 1
-        if pattern != self.current_pattern:
-            self.current_pattern = pattern
-            self.update_grid()  # Refresh the grid to display the new pattern
-            self.pattern_label.setText(f"P{pattern + 1}")
+        # Song and chain playback switch the edited pattern once its first step is actually played
+        if pattern != -1 and pattern != self.current_pattern:
+            self.switch_pattern(pattern)
+
+    def set_automation(self, value):
+        """Set (or clear with None) a point of the selected CC lane on every selected step."""
+        _, start, end = self.selection()
+        for step in range(start, end):
+            self.controller.set_automation_point(self.cc_input.value(), step, value)
+        self.update_grid()
+
+    def toggle_recording(self):
+        """Start or stop recording from the MIDI input into the current pattern."""
+        if self.record_button.isChecked():
+            self.midi_recorder.set_record_track(self.cursor_track)
+            if not self.midi_recorder.start():
+                self.record_button.setChecked(False)
+        else:
+            self.midi_recorder.stop()
+
+    def on_input_device_selected(self, index):
+        self.record_button.setChecked(False)
+        self.midi_recorder.set_input_device(self.midi_input_dropdown.itemText(index))
+
+    def update_loop(self):
+        """Pass the loop region (1-based, inclusive) to the player."""
+        start = self.loop_start_input.value()
+        end = self.loop_end_input.value()
+        # Keep the two boxes from crossing, so they always show the region the player uses
+        self.loop_end_input.setMinimum(start)
+        self.loop_start_input.setMaximum(end)
+        self.midi_player.set_loop_region(start - 1, end)
+
+    def update_chain(self):
+        """Pass the pattern chain, typed as pattern numbers (e.g. 1123), to the player."""
+        chain = [int(c) - 1 for c in self.chain_input.text() if c in '1234']
+        self.midi_player.set_pattern_chain(chain)